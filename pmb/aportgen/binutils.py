@@ -4,6 +4,11 @@ import pmb.aportgen.core
 import pmb.helpers.git
 import pmb.helpers.run
 
+below_header_template = """
+        CTARGET_ARCH={arch}
+        CTARGET="$(arch_to_hostspec $CTARGET_ARCH)"
+    """
+
 
 def generate(args, pkgname):
     # Copy original aport
@@ -18,10 +23,7 @@ def generate(args, pkgname):
         "arch": pmb.config.arch_native,
     }
 
-    below_header = """
-        CTARGET_ARCH=""" + arch + """
-        CTARGET="$(arch_to_hostspec $CTARGET_ARCH)"
-    """
+    below_header = below_header_template.format(arch=arch)
 
     pmb.aportgen.core.rewrite(args, pkgname, "main/binutils", fields,
                               "binutils", below_header=below_header)
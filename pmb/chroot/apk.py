@@ -1,13 +1,15 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import itertools
 import os
 import logging
-import shlex
+import tempfile
 
 import pmb.chroot
 import pmb.config
 import pmb.helpers.apk
 import pmb.helpers.pmaports
+import pmb.helpers.repo
 import pmb.parse.apkindex
 import pmb.parse.arch
 import pmb.parse.depends
@@ -33,15 +35,17 @@ def update_repository_list(args, suffix="native", check=False):
     lines_old = []
     if os.path.exists(path):
         # Read all old lines
-        lines_old = []
         with open(path) as handle:
-            for line in handle:
-                lines_old.append(line[:-1])
+            lines_old = handle.read().splitlines()
     else:
         pmb.helpers.run.root(args, ["mkdir", "-p", os.path.dirname(path)])
 
     # Up to date: Save cache, return
-    lines_new = pmb.helpers.repo.urls(args)
+    lines_new = pmb.helpers.other.cache["apk_repository_urls"]
+    if lines_new is None:
+        # Same for all suffixes, only depends on args and pmaports.cfg
+        lines_new = pmb.helpers.repo.urls(args)
+        pmb.helpers.other.cache["apk_repository_urls"] = lines_new
     if lines_old == lines_new:
         pmb.helpers.other.cache["apk_repository_list_updated"].append(suffix)
         return
@@ -52,11 +56,13 @@ def update_repository_list(args, suffix="native", check=False):
 
     # Update the file
     logging.debug(f"({suffix}) update /etc/apk/repositories")
-    if os.path.exists(path):
-        pmb.helpers.run.root(args, ["rm", path])
-    for line in lines_new:
-        pmb.helpers.run.root(args, ["sh", "-c", "echo "
-                                    f"{shlex.quote(line)} >> {path}"])
+    fd, temp_path = tempfile.mkstemp(".repositories", "pmbootstrap")
+    try:
+        with open(fd, "w") as handle:
+            handle.write("\n".join(lines_new) + "\n")
+        pmb.helpers.run.root(args, ["install", "-m", "644", temp_path, path])
+    finally:
+        os.remove(temp_path)
     update_repository_list(args, suffix, True)
 
 
@@ -77,7 +83,7 @@ def check_min_version(args, suffix="native"):
         return
 
     # Compare
-    version_installed = installed(args, suffix)["apk-tools"]["version"]
+    version_installed = installed_version(args, "apk-tools", suffix)
     pmb.helpers.apk.check_outdated(
         args, version_installed,
         "Delete your http cache and zap all chroots, then try again:"
@@ -87,7 +93,7 @@ def check_min_version(args, suffix="native"):
     pmb.helpers.other.cache["apk_min_version_checked"].append(suffix)
 
 
-def install_build(args, package, arch):
+def install_build(args, package, arch, indexes=None):
     """
     Build an outdated package unless pmbootstrap was invoked with
     "pmbootstrap install" and the option to build packages during pmb install
@@ -95,10 +101,13 @@ def install_build(args, package, arch):
 
     :param package: name of the package to build
     :param arch: architecture of the package to build
+    :param indexes: list of APKINDEX.tar.gz paths to look for the binary
+                    package in, defaults to all index files of arch
     """
     # User may have disabled building packages during "pmbootstrap install"
     if args.action == "install" and not args.build_pkgs_on_install:
-        if not pmb.parse.apkindex.package(args, package, arch, False):
+        if not pmb.parse.apkindex.package(args, package, arch, False,
+                                          indexes):
             raise RuntimeError(f"{package}: no binary package found for"
                                f" {arch}, and compiling packages during"
                                " 'pmbootstrap install' has been disabled."
@@ -122,14 +131,8 @@ def packages_split_to_add_del(packages):
     :returns: (to_add, to_del) - tuple of lists of pkgnames, e.g.
               (["hello-world", ...], ["some-conflict-pkg", ...])
     """
-    to_add = []
-    to_del = []
-
-    for package in packages:
-        if package.startswith("!"):
-            to_del.append(package.lstrip("!"))
-        else:
-            to_add.append(package)
+    to_add = [p for p in packages if not p.startswith("!")]
+    to_del = [p[1:] for p in packages if p.startswith("!")]
 
     return (to_add, to_del)
 
@@ -146,15 +149,22 @@ def packages_get_locally_built_apks(args, packages, arch):
               ["/mnt/pmbootstrap-packages/x86_64/hello-world-1-r6.apk", ...]
     """
     channel = pmb.config.pmaports.read_config(args)["channel"]
+    local_repo = f"{args.work}/packages/{channel}/{arch}"
     ret = []
 
+    # Skip looking up all packages if nothing was built locally for this arch
+    if not os.path.exists(local_repo):
+        return ret
+
+    indexes = pmb.helpers.repo.apkindex_files(args, arch)
     for package in packages:
-        data_repo = pmb.parse.apkindex.package(args, package, arch, False)
+        data_repo = pmb.parse.apkindex.package(args, package, arch, False,
+                                               indexes)
         if not data_repo:
             continue
 
         apk_file = f"{package}-{data_repo['version']}.apk"
-        if not os.path.exists(f"{args.work}/packages/{channel}/{arch}/{apk_file}"):
+        if not os.path.exists(f"{local_repo}/{apk_file}"):
             continue
 
         ret.append(f"/mnt/pmbootstrap-packages/{arch}/{apk_file}")
@@ -176,9 +186,10 @@ def install_run_apk(args, to_add, to_add_local, to_del, suffix):
     """
     # Sanitize packages: don't allow '--allow-untrusted' and other options
     # to be passed to apk!
-    for package in to_add + to_add_local + to_del:
-        if package.startswith("-"):
-            raise ValueError(f"Invalid package name: {package}")
+    invalid = next((p for p in itertools.chain(to_add, to_add_local, to_del)
+                    if p.startswith("-")), None)
+    if invalid:
+        raise ValueError(f"Invalid package name: {invalid}")
 
     commands = [["add"] + to_add]
 
@@ -204,6 +215,11 @@ def install_run_apk(args, to_add, to_add_local, to_del, suffix):
             pmb.chroot.root(args, ["apk", "--no-progress"] + command,
                             suffix=suffix)
 
+    # Parsing the installed packages database is cached by its last modified
+    # time, which may not change on filesystems with coarse timestamps.
+    # Invalidate the cache, so installed() never returns outdated results.
+    pmb.parse.apkindex.clear_cache(installed_path(args, suffix))
+
 
 def install(args, packages, suffix="native", build=True):
     """
@@ -233,8 +249,10 @@ def install(args, packages, suffix="native", build=True):
     to_add, to_del = packages_split_to_add_del(packages_with_depends)
 
     if build:
+        # Resolve the APKINDEX paths once, not for every single package
+        indexes = pmb.helpers.repo.apkindex_files(args, arch)
         for package in to_add:
-            install_build(args, package, arch)
+            install_build(args, package, arch, indexes)
 
     to_add_local = packages_get_locally_built_apks(args, to_add, arch)
     to_add_no_deps, _ = packages_split_to_add_del(packages)
@@ -243,10 +261,16 @@ def install(args, packages, suffix="native", build=True):
     install_run_apk(args, to_add_no_deps, to_add_local, to_del, suffix)
 
 
+def installed_path(args, suffix="native"):
+    """ :returns: outside path to apk's installed packages database """
+    return f"{args.work}/chroot_{suffix}/lib/apk/db/installed"
+
+
 def installed(args, suffix="native"):
     """
     Read the list of installed packages (which has almost the same format, as
-    an APKINDEX, but with more keys).
+    an APKINDEX, but with more keys). The result is cached for the current
+    session, until the file gets modified or install_run_apk() runs.
 
     :returns: a dictionary with the following structure:
               { "postmarketos-mkinitfs":
@@ -258,5 +282,34 @@ def installed(args, suffix="native"):
                 }, ...
               }
     """
-    path = f"{args.work}/chroot_{suffix}/lib/apk/db/installed"
-    return pmb.parse.apkindex.parse(path, False)
+    return pmb.parse.apkindex.parse(installed_path(args, suffix), False)
+
+
+def installed_version(args, pkgname, suffix="native"):
+    """
+    Get the version of one installed package, without parsing the whole
+    installed packages database like installed() does.
+
+    :param pkgname: name of the installed package, e.g. "apk-tools"
+    :returns: version string, e.g. "2.14.0-r2"
+    """
+    line_pkgname = f"P:{pkgname}"
+    found = False
+    version = None
+    with open(installed_path(args, suffix)) as handle:
+        for line in handle:
+            # The last line may not end in a newline
+            line = line.rstrip("\n")
+            if not line:
+                if found:
+                    break
+                version = None
+            elif line == line_pkgname:
+                found = True
+            elif line.startswith("V:"):
+                version = line[2:]
+    if not found:
+        raise RuntimeError(f"({suffix}) package {pkgname} is not listed in"
+                           " the installed packages database:"
+                           f" {installed_path(args, suffix)}")
+    return version
@@ -24,16 +24,16 @@ def kernel(args):
 
     # Generate the paths and run the flasher
     if args.action_flasher == "boot":
-        logging.info("(native) boot " + flavor + " kernel")
+        logging.info("(native) boot %s kernel", flavor)
         pmb.flasher.run(args, "boot", flavor)
     else:
-        logging.info("(native) flash kernel " + flavor)
+        logging.info("(native) flash kernel %s", flavor)
         pmb.flasher.run(args, "flash_kernel", flavor)
     logging.info("You will get an IP automatically assigned to your "
                  "USB interface shortly.")
     logging.info("Then you can connect to your device using ssh after pmOS has"
                  " booted:")
-    logging.info("ssh {}@{}".format(args.user, pmb.config.default_ip))
+    logging.info("ssh %s@%s", args.user, pmb.config.default_ip)
     logging.info("NOTE: If you enabled full disk encryption, you should make"
                  " sure that osk-sdl has been properly configured for your"
                  " device")
@@ -41,8 +41,8 @@ def kernel(args):
 
 def list_flavors(args):
     suffix = "rootfs_" + args.device
-    logging.info("(" + suffix + ") installed kernel flavors:")
-    logging.info("* " + pmb.chroot.other.kernel_flavor_installed(args, suffix))
+    logging.info("(%s) installed kernel flavors:", suffix)
+    logging.info("* %s", pmb.chroot.other.kernel_flavor_installed(args, suffix))
 
 
 def rootfs(args):
@@ -62,9 +62,8 @@ def rootfs(args):
     # Do not flash if using fastboot & image is too large
     if method.startswith("fastboot") \
             and args.deviceinfo["flash_fastboot_max_size"]:
-        img_size = os.path.getsize(img_path) / 1024**2
-        max_size = int(args.deviceinfo["flash_fastboot_max_size"])
-        if img_size > max_size:
+        max_size = int(args.deviceinfo["flash_fastboot_max_size"]) * 1024**2
+        if os.path.getsize(img_path) > max_size:
             raise RuntimeError("The rootfs is too large for fastboot to"
                                " flash.")
 
@@ -122,6 +121,19 @@ def flash_lk2nd(args):
     pmb.flasher.run(args, "flash_lk2nd")
 
 
+actions = {
+    "boot": kernel,
+    "flash_kernel": kernel,
+    "flash_rootfs": rootfs,
+    "flash_vbmeta": flash_vbmeta,
+    "flash_dtbo": flash_dtbo,
+    "list_flavors": list_flavors,
+    "list_devices": list_devices,
+    "sideload": sideload,
+    "flash_lk2nd": flash_lk2nd,
+}
+
+
 def frontend(args):
     action = args.action_flasher
     method = args.flash_method or args.deviceinfo["flash_method"]
@@ -135,19 +147,4 @@ def frontend(args):
         logging.info("This device doesn't support any flash method.")
         return
 
-    if action in ["boot", "flash_kernel"]:
-        kernel(args)
-    if action == "flash_rootfs":
-        rootfs(args)
-    if action == "flash_vbmeta":
-        flash_vbmeta(args)
-    if action == "flash_dtbo":
-        flash_dtbo(args)
-    if action == "list_flavors":
-        list_flavors(args)
-    if action == "list_devices":
-        list_devices(args)
-    if action == "sideload":
-        sideload(args)
-    if action in ["flash_lk2nd"]:
-        flash_lk2nd(args)
+    actions[action](args)
@@ -73,6 +73,32 @@ def bind_file(args, source, destination, create_folders=False):
                                 destination])
 
 
+# Arguments: pairs of source and destination
+bind_files_script = ('while [ "$#" -gt 0 ]; do'
+                     ' { [ -e "$2" ] || touch "$2"; } &&'
+                     ' mount --bind "$1" "$2" || exit 1;'
+                     ' shift 2; done')
+
+
+def bind_files(args, pairs):
+    """
+    Mount multiple files with the --bind option in one root call, and create
+    the destination files, if necessary. Same as calling bind_file() for each
+    pair, but it doesn't run sudo/doas multiple times.
+
+    :param pairs: list of (source, destination) tuples
+    """
+    script_args = []
+    for source, destination in pairs:
+        # Skip existing mountpoint
+        if not ismount(destination):
+            script_args += [source, destination]
+
+    if script_args:
+        pmb.helpers.run.root(args, ["sh", "-c", bind_files_script, "-"] +
+                             script_args)
+
+
 def umount_all_list(prefix, source="/proc/mounts"):
     """
     Parses `/proc/mounts` for all folders beginning with a prefix.
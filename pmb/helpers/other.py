@@ -305,7 +305,9 @@ def init_cache():
              "apkbuild": {},
              "apk_min_version_checked": [],
              "apk_repository_list_updated": [],
+             "apk_repository_urls": None,
              "built": {},
+             "deviceinfo": {},
              "find_aport": {},
              "pmb.helpers.package.depends_recurse": {},
              "pmb.helpers.package.get": {},
@@ -18,12 +18,10 @@ def flat_cmd(cmd, working_dir=None, env={}):
               echo 'string with spaces'
               cd /home/pmos;echo 'string with spaces'
     """
-    # Merge env and cmd into escaped list
-    escaped = []
-    for key, value in env.items():
-        escaped.append(key + "=" + shlex.quote(value))
-    for i in range(len(cmd)):
-        escaped.append(shlex.quote(cmd[i]))
+    # Merge env and cmd into escaped list (like shlex.join(), which is not
+    # available in Python 3.6)
+    escaped = [key + "=" + shlex.quote(value) for key, value in env.items()]
+    escaped += map(shlex.quote, cmd)
 
     # Prepend working dir
     ret = " ".join(escaped)
@@ -1,10 +1,11 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import bisect
 import logging
 import os
-import re
 import glob
 import shlex
+import tempfile
 
 import pmb.chroot
 import pmb.chroot.apk
@@ -126,25 +127,31 @@ def copy_files_from_chroot(args, suffix):
     if os.path.exists(fifo):
         pmb.helpers.run.root(args, ["rm", fifo])
 
-    # Get all folders inside the device rootfs (except for home)
-    folders = []
-    for path in glob.glob(mountpoint_outside + "/*"):
-        if path.endswith("/home"):
-            continue
-        folders += [os.path.basename(path)]
-
     # Update or copy all files
     if args.rsync:
+        # Get all folders inside the device rootfs (except for home and hidden
+        # files, like glob would skip them)
+        with os.scandir(mountpoint_outside) as entries:
+            folders = [entry.name for entry in entries
+                       if entry.name != "home" and
+                       not entry.name.startswith(".")]
+
         pmb.chroot.apk.install(args, ["rsync"])
-        rsync_flags = "-a"
+        # Local copy: skip the delta algorithm and keep the numeric owner IDs
+        # of the rootfs
+        rsync_flags = ["-a", "--whole-file", "--inplace", "--numeric-ids"]
         if args.verbose:
-            rsync_flags += "vP"
-        pmb.chroot.root(args, ["rsync", rsync_flags, "--delete"] + folders +
-                        ["/mnt/install/"], working_dir=mountpoint)
+            rsync_flags += ["--info=progress2"]
+        pmb.chroot.root(args, ["rsync"] + rsync_flags + ["--delete"] +
+                        folders + ["/mnt/install/"], working_dir=mountpoint)
         pmb.chroot.root(args, ["rm", "-rf", "/mnt/install/home"])
     else:
-        pmb.chroot.root(args, ["cp", "-a"] + folders + ["/mnt/install/"],
-                        working_dir=mountpoint)
+        # Let find pass all top-level entries (except for home and hidden
+        # files) to a single cp call, without listing them in Python first
+        pmb.chroot.root(args, ["find", ".", "-mindepth", "1", "-maxdepth", "1",
+                               "!", "-name", "home", "!", "-name", ".*",
+                               "-exec", "cp", "-a", "-t", "/mnt/install/",
+                               "{}", "+"], working_dir=mountpoint)
 
 
 def create_home_from_skel(args):
@@ -153,12 +160,12 @@ def create_home_from_skel(args):
     """
     rootfs = args.work + "/chroot_native/mnt/install"
     homedir = rootfs + "/home/" + args.user
-    pmb.helpers.run.root(args, ["mkdir", rootfs + "/home"])
     if os.path.exists(f"{rootfs}/etc/skel"):
-        pmb.helpers.run.root(args, ["cp", "-a", f"{rootfs}/etc/skel", homedir])
+        script = 'mkdir "$1/home" && cp -a "$1/etc/skel" "$2"'
     else:
-        pmb.helpers.run.root(args, ["mkdir", homedir])
-    pmb.helpers.run.root(args, ["chown", "-R", "10000", homedir])
+        script = 'mkdir "$1/home" "$2"'
+    script += ' && chown -R 10000 "$2"'
+    pmb.helpers.run.root(args, ["sh", "-c", script, "-", rootfs, homedir])
 
 
 def configure_apk(args):
@@ -168,28 +175,32 @@ def configure_apk(args):
     and remove the /mnt/pmbootstrap-packages repository.
     """
     # Official keys
-    pattern = f"{pmb.config.apk_keys_path}/*.pub"
+    keys_dir = pmb.config.apk_keys_path
 
     # Official keys + local keys
     if args.install_local_pkgs:
-        pattern = f"{args.work}/config_apk_keys/*.pub"
+        keys_dir = f"{args.work}/config_apk_keys"
 
     # Copy over keys
     rootfs = args.work + "/chroot_native/mnt/install"
-    for key in glob.glob(pattern):
-        pmb.helpers.run.root(args, ["cp", key, rootfs + "/etc/apk/keys/"])
+    keys = glob.glob(f"{keys_dir}/*.pub")
+    if keys:
+        pmb.helpers.run.root(args, ["cp"] + keys +
+                             [rootfs + "/etc/apk/keys/"])
 
     # Copy over the corresponding APKINDEX files from cache
     index_files = pmb.helpers.repo.apkindex_files(args,
                                                   arch=args.deviceinfo["arch"],
                                                   user_repository=False)
-    for f in index_files:
-        pmb.helpers.run.root(args, ["cp", f, rootfs + "/var/cache/apk/"])
+    if index_files:
+        pmb.helpers.run.root(args, ["cp"] + index_files +
+                             [rootfs + "/var/cache/apk/"])
 
     # Disable pmbootstrap repository
     pmb.helpers.run.root(args, ["sed", "-i", r"/\/mnt\/pmbootstrap-packages/d",
                                 rootfs + "/etc/apk/repositories"])
-    pmb.helpers.run.user(args, ["cat", rootfs + "/etc/apk/repositories"])
+    with open(rootfs + "/etc/apk/repositories") as handle:
+        logging.debug("/etc/apk/repositories:\n" + handle.read())
 
 
 def set_user(args):
@@ -205,10 +216,15 @@ def set_user(args):
         pmb.chroot.root(args, ["adduser", "-D", "-u", "10000", args.user],
                         suffix)
     groups = pmb.install.ui.get_groups(args) + pmb.config.install_user_groups
+
+    # Add the user to all groups in one chroot call. "addgroup -S" may fail,
+    # because the group exists already.
+    script = "set -e"
     for group in groups:
-        pmb.chroot.root(args, ["addgroup", "-S", group], suffix,
-                        check=False)
-        pmb.chroot.root(args, ["addgroup", args.user, group], suffix)
+        group = shlex.quote(group)
+        script += (f"; addgroup -S {group} || true"
+                   f"; addgroup {shlex.quote(args.user)} {group}")
+    pmb.chroot.root(args, ["sh", "-c", script], suffix)
 
 
 def setup_login_chpasswd_user_from_arg(args, suffix):
@@ -286,9 +302,11 @@ def copy_ssh_keys(args):
     if not args.ssh_keys:
         return
     keys = []
-    for key in glob.glob(os.path.expanduser(args.ssh_key_glob)):
+    for key in glob.iglob(os.path.expanduser(args.ssh_key_glob)):
         with open(key, "r") as infile:
-            keys += infile.readlines()
+            content = infile.read()
+        if content:
+            keys.append(content)
 
     if not len(keys):
         logging.info("NOTE: Public SSH keys not found. Since no SSH keys "
@@ -296,19 +314,20 @@ def copy_ssh_keys(args):
                      "authentication!")
         return
 
-    authorized_keys = args.work + "/chroot_native/tmp/authorized_keys"
-    outfile = open(authorized_keys, "w")
-    for key in keys:
-        outfile.write("%s" % key)
-    outfile.close()
+    fd, authorized_keys = tempfile.mkstemp("authorized_keys", "pmbootstrap")
+    try:
+        with open(fd, "w") as outfile:
+            outfile.write("".join(keys))
 
-    target = f"{args.work}/chroot_native/mnt/install/home/{args.user}/.ssh"
-    pmb.helpers.run.root(args, ["mkdir", target])
-    pmb.helpers.run.root(args, ["chmod", "700", target])
-    pmb.helpers.run.root(args, ["cp", authorized_keys, target +
-                                "/authorized_keys"])
-    pmb.helpers.run.root(args, ["rm", authorized_keys])
-    pmb.helpers.run.root(args, ["chown", "-R", "10000:10000", target])
+        # Create the .ssh dir and copy the keys with the right owner and mode
+        target = f"{args.work}/chroot_native/mnt/install/home/{args.user}/.ssh"
+        owner = ["-o", "10000", "-g", "10000"]
+        pmb.helpers.run.root(args, ["install", "-d", "-m", "700"] + owner +
+                             [target])
+        pmb.helpers.run.root(args, ["install", "-m", "644"] + owner +
+                             [authorized_keys, target + "/authorized_keys"])
+    finally:
+        os.remove(authorized_keys)
 
 
 def setup_keymap(args):
@@ -354,6 +373,12 @@ def setup_keymap(args):
         logging.info("NOTE: No valid keymap specified for device")
 
 
+# $1: hostname
+setup_hostname_script = ('echo "$1" > /etc/hostname && sed -i -e'
+                         r' "s/^127\.0\.0\.1.*/127.0.0.1\t$1'
+                         ' localhost.localdomain localhost/" /etc/hosts')
+
+
 def setup_hostname(args):
     """
     Set the hostname and update localhost address in /etc/hosts
@@ -368,13 +393,11 @@ def setup_hostname(args):
                            " run 'pmbootstrap init' to configure it.")
 
     suffix = "rootfs_" + args.device
-    # Generate /etc/hostname
-    pmb.chroot.root(args, ["sh", "-c", "echo " + shlex.quote(hostname) +
-                           " > /etc/hostname"], suffix)
-    # Update /etc/hosts
-    regex = (r"s/^127\.0\.0\.1.*/127.0.0.1\t" + re.escape(hostname) +
-             " localhost.localdomain localhost/")
-    pmb.chroot.root(args, ["sed", "-i", "-e", regex, "/etc/hosts"], suffix)
+    # Generate /etc/hostname and update /etc/hosts in one chroot call. The
+    # hostname was validated above, so it can be used in the sed expression
+    # without escaping.
+    pmb.chroot.root(args, ["sh", "-c", setup_hostname_script, "-", hostname],
+                    suffix)
 
 
 def setup_appstream(args):
@@ -396,6 +419,31 @@ def setup_appstream(args):
                            "-t", "/var/lib/swcatalog"], suffix)
 
 
+def find_in_runlevels(args, suffix, service):
+    """
+    Find all runlevels a service is enabled in, without entering the chroot.
+
+    :param suffix: the chroot suffix, e.g. "rootfs_qemu-amd64"
+    :param service: name of the OpenRC service, e.g. "sshd"
+    :returns: list of paths relative to /etc/runlevels, e.g.
+              ["default/sshd"]
+    """
+    runlevels = f"{args.work}/chroot_{suffix}/etc/runlevels"
+    if not os.path.isdir(runlevels):
+        raise RuntimeError(f"Could not find OpenRC runlevels: {runlevels}")
+
+    # os.walk() ignores errors by default, which would look like the service
+    # is not enabled (e.g. if a runlevel dir can't be read)
+    def onerror(error):
+        raise error
+
+    ret = []
+    for dirpath, dirnames, filenames in os.walk(runlevels, onerror=onerror):
+        if service in filenames or service in dirnames:
+            ret.append(os.path.relpath(f"{dirpath}/{service}", runlevels))
+    return ret
+
+
 def disable_sshd(args):
     if not args.no_sshd:
         return
@@ -406,9 +454,7 @@ def disable_sshd(args):
                     check=False)
 
     # Verify that it's gone
-    sshd_files = pmb.helpers.run.root(
-        args, ["find", "-name", "sshd"], output_return=True,
-        working_dir=f"{args.work}/chroot_{suffix}/etc/runlevels")
+    sshd_files = find_in_runlevels(args, suffix, "sshd")
     if sshd_files:
         raise RuntimeError(f"Failed to disable sshd service: {sshd_files}")
 
@@ -444,9 +490,7 @@ def disable_firewall(args):
                     check=False)
 
     # Verify that it's gone
-    nftables_files = pmb.helpers.run.root(
-        args, ["find", "-name", "nftables"], output_return=True,
-        working_dir=f"{args.work}/chroot_{suffix}/etc/runlevels")
+    nftables_files = find_in_runlevels(args, suffix, "nftables")
     if nftables_files:
         raise RuntimeError(f"Failed to disable firewall: {nftables_files}")
 
@@ -502,7 +546,7 @@ def generate_binary_list(args, suffix, step):
                    f"rootfs_{args.device}", or f"installer_{args.device}")
     :param step: partition step size in bytes
     """
-    binary_ranges = {}
+    binary_ranges = []
     binary_list = []
     binaries = args.deviceinfo["sd_embed_firmware"].split(",")
 
@@ -515,7 +559,9 @@ def generate_binary_list(args, suffix, step):
                                f"not valid: {offset}")
         binary_path = os.path.join(args.work, f"chroot_{suffix}", "usr/share",
                                    binary)
-        if not os.path.exists(binary_path):
+        try:
+            binary_size = os.stat(binary_path).st_size
+        except FileNotFoundError:
             raise RuntimeError("The following firmware binary does not "
                                f"exist in the {suffix} chroot: "
                                f"/usr/share/{binary}")
@@ -523,21 +569,22 @@ def generate_binary_list(args, suffix, step):
         # first partition
         boot_part_start = args.deviceinfo["boot_part_start"] or "2048"
         max_size = (int(boot_part_start) * 512) - (offset * step)
-        binary_size = os.path.getsize(binary_path)
         if binary_size > max_size:
             raise RuntimeError("The firmware is too big to embed in the "
                                f"disk image {binary_size}B > {max_size}B")
         # Insure that the firmware does not conflict with any other firmware
-        # that will be embedded
+        # that will be embedded. binary_ranges is sorted and free of overlaps,
+        # so only the direct neighbours need to be checked.
         binary_start = offset * step
         binary_end = binary_start + binary_size
-        for start, end in binary_ranges.items():
-            if ((binary_start >= start and binary_start < end) or
-                    (binary_end > start and binary_end <= end)):
-                raise RuntimeError("The firmware overlaps with at least one "
-                                   f"other firmware image: {binary}")
-
-        binary_ranges[binary_start] = binary_end
+        i = bisect.bisect_right(binary_ranges, (binary_start, binary_end))
+        if ((i > 0 and binary_ranges[i - 1][1] > binary_start) or
+                (i < len(binary_ranges) and
+                 binary_ranges[i][0] < binary_end)):
+            raise RuntimeError("The firmware overlaps with at least one "
+                               f"other firmware image: {binary}")
+
+        binary_ranges.insert(i, (binary_start, binary_end))
         binary_list.append((binary, offset))
 
     return binary_list
@@ -569,14 +616,17 @@ def embed_firmware(args, suffix):
     device_rootfs = mount_device_rootfs(args, suffix)
     binary_list = generate_binary_list(args, suffix, step)
 
-    # Write binaries to disk
+    # Write binaries to disk (one chroot call for all of them)
+    commands = []
     for binary, offset in binary_list:
         binary_file = os.path.join("/usr/share", binary)
         logging.info("Embed firmware {} in the SD card image at offset {} with"
                      " step size {}".format(binary, offset, step))
         filename = os.path.join(device_rootfs, binary_file.lstrip("/"))
-        pmb.chroot.root(args, ["dd", "if=" + filename, "of=/dev/install",
-                               "bs=" + str(step), "seek=" + str(offset)])
+        commands.append(pmb.helpers.run.flat_cmd(
+            ["dd", "if=" + filename, "of=/dev/install", "bs=" + str(step),
+             "seek=" + str(offset)]))
+    pmb.chroot.root(args, ["sh", "-c", " && ".join(commands)])
 
 
 def write_cgpt_kpart(args, layout, suffix):
@@ -595,31 +645,50 @@ def write_cgpt_kpart(args, layout, suffix):
         args, ["dd", f"if={filename}", f"of=/dev/installp{layout['kernel']}"])
 
 
-def sanity_check_sdcard(args):
+def read_sysfs_block_attrs(device):
+    """
+    Read the sysfs attributes of a block device, which are needed for the
+    sanity checks below. The device path gets resolved only once here, so
+    symlinks like /dev/disk/by-id/... work as well.
+
+    :param device: path to the block device, e.g. "/dev/mmcblk0"
+    :returns: dict with the resolved path and the attributes that exist, e.g.
+              {"devpath": "/dev/mmcblk0", "ro": "0", "size": "62333952"}
+    """
+    devpath = os.path.realpath(device)
+    sysfs = f"/sys/class/block/{os.path.basename(devpath)}"
+    ret = {"devpath": devpath}
+    for attr in ["ro", "size"]:
+        try:
+            with open(f"{sysfs}/{attr}") as handle:
+                ret[attr] = handle.read().strip()
+        except OSError:
+            continue
+    return ret
+
+
+def sanity_check_sdcard(args, attrs):
+    """
+    :param attrs: return value of read_sysfs_block_attrs()
+    """
     device = args.sdcard
-    device_name = os.path.basename(device)
     if not os.path.exists(device):
         raise RuntimeError(f"{device} doesn't exist, is the sdcard plugged?")
-    if os.path.isdir('/sys/class/block/{}'.format(device_name)):
-        with open('/sys/class/block/{}/ro'.format(device_name), 'r') as handle:
-            ro = handle.read()
-        if ro == '1\n':
-            raise RuntimeError(f"{device} is read-only, is the sdcard locked?")
+    if attrs.get("ro") == "1":
+        raise RuntimeError(f"{device} is read-only, is the sdcard locked?")
 
 
-def sanity_check_sdcard_size(args):
-    device = args.sdcard
-    devpath = os.path.realpath(device)
-    sysfs = '/sys/class/block/{}/size'.format(devpath.replace('/dev/', ''))
-    if not os.path.isfile(sysfs):
+def sanity_check_sdcard_size(args, attrs):
+    """
+    :param attrs: return value of read_sysfs_block_attrs()
+    """
+    if "size" not in attrs:
         # This is a best-effort sanity check, continue if it's not checkable
         return
 
-    with open(sysfs) as handle:
-        raw = handle.read()
-
     # Size is in 512-byte blocks
-    size = int(raw.strip())
+    devpath = attrs["devpath"]
+    size = int(attrs["size"])
     human = "{:.2f} GiB".format(size / 2 / 1024 / 1024)
 
     # Warn if the size is larger than 100GiB
@@ -735,9 +804,8 @@ def install_system_image(args, size_reserve, suffix, step, steps,
         pmb.chroot.apk.install(args, ["android-tools"])
         sys_image = args.device + ".img"
         sys_image_sparse = args.device + "-sparse.img"
-        pmb.chroot.user(args, ["img2simg", sys_image, sys_image_sparse],
-                        working_dir="/home/pmos/rootfs/")
-        pmb.chroot.user(args, ["mv", "-f", sys_image_sparse, sys_image],
+        pmb.chroot.user(args, ["sh", "-c", 'img2simg "$1" "$2" && mv -f "$2" "$1"',
+                               "-", sys_image, sys_image_sparse],
                         working_dir="/home/pmos/rootfs/")
 
         # patch sparse image for Samsung devices if specified
@@ -747,11 +815,10 @@ def install_system_image(args, size_reserve, suffix, step, steps,
             pmb.chroot.apk.install(args, ["sm-sparse-image-tool"])
             sys_image = f"{args.device}.img"
             sys_image_patched = f"{args.device}-patched.img"
-            pmb.chroot.user(args, ["sm_sparse_image_tool", "samsungify", "--strategy",
+            pmb.chroot.user(args, ["sh", "-c", 'sm_sparse_image_tool samsungify --strategy'
+                                   ' "$1" "$2" "$3" && mv -f "$3" "$2"', "-",
                                    samsungify_strategy, sys_image, sys_image_patched],
                             working_dir="/home/pmos/rootfs/")
-            pmb.chroot.user(args, ["mv", "-f", sys_image_patched, sys_image],
-                            working_dir="/home/pmos/rootfs/")
 
 
 def print_flash_info(args):
@@ -852,7 +919,13 @@ def install_recovery_zip(args, steps):
     logging.info("https://postmarketos.org/recoveryzip")
 
 
+ondev_cp_script = ('while [ "$#" -gt 0 ]; do'
+                   ' install -Dm644 "$1" "$2" || exit 1; shift 2; done')
+
+
 def install_on_device_installer(args, step, steps):
+    pmaports_cfg = pmb.config.pmaports.read_config(args)
+
     # Generate the rootfs image
     if not args.ondev_no_rootfs:
         suffix_rootfs = f"rootfs_{args.device}"
@@ -885,7 +958,7 @@ def install_on_device_installer(args, step, steps):
     # file into another format. This can all be done without pmbootstrap
     # changes in the postmarketos-ondev package.
     logging.info(f"({suffix_installer}) ondev-prepare")
-    channel = pmb.config.pmaports.read_config(args)["channel"]
+    channel = pmaports_cfg["channel"]
     channel_cfg = pmb.config.pmaports.read_config_channel(args)
     env = {"ONDEV_CHANNEL": channel,
            "ONDEV_CHANNEL_BRANCH_APORTS": channel_cfg["branch_aports"],
@@ -899,26 +972,31 @@ def install_on_device_installer(args, step, steps):
 
     # Copy files specified with 'pmbootstrap install --ondev --cp'
     if args.ondev_cp:
+        # Install all files with one root call, the script gets the pairs of
+        # source and destination paths as arguments
+        install_args = []
         for host_src, chroot_dest in args.ondev_cp:
             host_dest = f"{args.work}/chroot_{suffix_installer}/{chroot_dest}"
             logging.info(f"({suffix_installer}) add {host_src} as"
                          f" {chroot_dest}")
-            pmb.helpers.run.root(args, ["install", "-Dm644", host_src,
-                                        host_dest])
+            install_args += [host_src, host_dest]
+        pmb.helpers.run.root(args, ["sh", "-c", ondev_cp_script, "-"] +
+                             install_args)
 
     # Remove $DEVICE-boot.img (we will generate a new one if --split was
     # specified, otherwise the separate boot image is not needed)
     if not args.ondev_no_rootfs:
         img_boot = f"{args.device}-boot.img"
-        logging.info(f"(native) rm {img_boot}")
-        pmb.chroot.root(args, ["rm", f"/home/pmos/rootfs/{img_boot}"])
+        img_boot_path = f"/home/pmos/rootfs/{img_boot}"
+        if os.path.exists(f"{args.work}/chroot_native{img_boot_path}"):
+            logging.info(f"(native) rm {img_boot}")
+            pmb.chroot.root(args, ["rm", "-f", img_boot_path])
 
     # Disable root login
     setup_login(args, suffix_installer)
 
     # Generate installer image
     size_reserve = round(os.path.getsize(img_path_dest) / 1024 / 1024) + 200
-    pmaports_cfg = pmb.config.pmaports.read_config(args)
     boot_label = pmaports_cfg.get("supported_install_boot_label",
                                   "pmOS_inst_boot")
     install_system_image(args, size_reserve, suffix_installer, step, steps,
@@ -981,6 +1059,10 @@ def create_device_rootfs(args, step, steps):
     if locale_is_set:
         install_packages += ["lang", "musl-locales"]
 
+    # Remove duplicates (e.g. packages that are both in --add and in the
+    # recommends of the UI), while keeping the order
+    install_packages = list(dict.fromkeys(install_packages))
+
     pmaports_cfg = pmb.config.pmaports.read_config(args)
     # postmarketos-base supports a dummy package for blocking osk-sdl install
     # when not required
@@ -1026,15 +1108,18 @@ def create_device_rootfs(args, step, steps):
     version = package["version"].split("-r")[0]
 
     if not pmb.parse.version.check_string(version, ">=3.14.0"):
-        pmb.chroot.root(args, ["setup-timezone", "-z", args.timezone], suffix)
+        commands = [["setup-timezone", "-z", args.timezone]]
     else:
-        pmb.chroot.root(args, ["setup-timezone", args.timezone], suffix)
+        commands = [["setup-timezone", args.timezone]]
 
     # Set locale
     if locale_is_set:
-        pmb.chroot.root(args, ["sed", "-i",
-                               f"s/LANG=C.UTF-8/LANG={args.locale}/",
-                               "/etc/profile.d/locale.sh"], suffix)
+        commands += [["sed", "-i", f"s/LANG=C.UTF-8/LANG={args.locale}/",
+                      "/etc/profile.d/locale.sh"]]
+
+    # Run both in one chroot call
+    pmb.chroot.root(args, ["sh", "-c", " && ".join(
+        pmb.helpers.run.flat_cmd(command) for command in commands)], suffix)
 
     # Set the hostname as the device name
     setup_hostname(args)
@@ -1048,8 +1133,9 @@ def create_device_rootfs(args, step, steps):
 def install(args):
     # Sanity checks
     if not args.android_recovery_zip and args.sdcard:
-        sanity_check_sdcard(args)
-        sanity_check_sdcard_size(args)
+        attrs = read_sysfs_block_attrs(args.sdcard)
+        sanity_check_sdcard(args, attrs)
+        sanity_check_sdcard_size(args, attrs)
     if args.on_device_installer:
         sanity_check_ondev_version(args)
 
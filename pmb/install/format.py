@@ -5,12 +5,17 @@ import logging
 import pmb.chroot
 
 
-def install_fsprogs(args, filesystem):
-    """ Install the package required to format a specific filesystem. """
-    fsprogs = pmb.config.filesystems.get(filesystem)
-    if not fsprogs:
-        raise RuntimeError(f"Unsupported filesystem: {filesystem}")
-    pmb.chroot.apk.install(args, [fsprogs])
+def install_fsprogs(args, filesystems):
+    """ Install the packages required to format specific filesystems.
+        :param filesystems: list of filesystems, e.g. ["ext2", "ext4"] """
+    fsprogs = []
+    for filesystem in filesystems:
+        package = pmb.config.filesystems.get(filesystem)
+        if not package:
+            raise RuntimeError(f"Unsupported filesystem: {filesystem}")
+        if package not in fsprogs:
+            fsprogs.append(package)
+    pmb.chroot.apk.install(args, fsprogs)
 
 
 def format_and_mount_boot(args, device, boot_label):
@@ -23,7 +28,6 @@ def format_and_mount_boot(args, device, boot_label):
     """
     mountpoint = "/mnt/install/boot"
     filesystem = args.deviceinfo["boot_filesystem"] or "ext2"
-    install_fsprogs(args, filesystem)
     logging.info(f"(native) format {device} (boot, {filesystem}), mount to"
                  " mountpoint")
     if filesystem == "fat16":
@@ -114,7 +118,6 @@ def format_and_mount_root(args, device, root_label, sdcard):
         else:
             raise RuntimeError(f"Don't know how to format {filesystem}!")
 
-        install_fsprogs(args, filesystem)
         logging.info(f"(native) format {device} (root, {filesystem})")
         pmb.chroot.root(args, mkfs_root_args + [device])
 
@@ -135,6 +138,12 @@ def format(args, layout, boot_label, root_label, sdcard):
     root_dev = f"/dev/installp{layout['root']}"
     boot_dev = f"/dev/installp{layout['boot']}"
 
+    # Install the programs for formatting both partitions with one apk call
+    filesystems = [args.deviceinfo["boot_filesystem"] or "ext2"]
+    if not args.rsync:
+        filesystems += [get_root_filesystem(args)]
+    install_fsprogs(args, filesystems)
+
     if args.full_disk_encryption:
         format_luks_root(args, root_dev)
         root_dev = "/dev/mapper/pm_crypt"
@@ -1,5 +1,6 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import itertools
 import logging
 import os
 import time
@@ -19,8 +20,6 @@ def partitions_mount(args, layout, sdcard):
         img_path = "/home/pmos/rootfs/" + args.device + ".img"
         prefix = pmb.install.losetup.device_by_back_file(args, img_path)
 
-    tries = 20
-
     # Devices ending with a number have a "p" before the partition number,
     # /dev/sda1 has no "p", but /dev/mmcblk0p1 has. See add_partition() in
     # block/partitions/core.c of linux.git.
@@ -28,28 +27,28 @@ def partitions_mount(args, layout, sdcard):
     if str.isdigit(prefix[-1:]):
         partition_prefix = f"{prefix}p"
 
-    found = False
-    for i in range(tries):
-        if os.path.exists(f"{partition_prefix}1"):
-            found = True
-            break
-        logging.debug(f"NOTE: ({i + 1}/{tries}) failed to find the install "
-                      "partition. Retrying...")
-        time.sleep(0.1)
-
-    if not found:
-        raise RuntimeError(f"Unable to find the first partition of {prefix}, "
-                           f"expected it to be at {partition_prefix}1!")
+    # The partition usually shows up right away, so start polling with a
+    # short delay and increase it up to 0.1s (2s timeout in total)
+    timeout = time.monotonic() + 2
+    delay = 0.005
+    while not os.path.exists(f"{partition_prefix}1"):
+        if time.monotonic() > timeout:
+            raise RuntimeError(f"Unable to find the first partition of"
+                               f" {prefix}, expected it to be at"
+                               f" {partition_prefix}1!")
+        logging.debug("NOTE: failed to find the install partition."
+                      " Retrying...")
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
 
     partitions = [layout["boot"], layout["root"]]
 
     if layout["kernel"]:
         partitions += [layout["kernel"]]
 
-    for i in partitions:
-        source = f"{partition_prefix}{i}"
-        target = args.work + "/chroot_native/dev/installp" + str(i)
-        pmb.helpers.mount.bind_file(args, source, target)
+    pmb.helpers.mount.bind_files(args, [
+        (f"{partition_prefix}{i}", f"{args.work}/chroot_native/dev/installp{i}")
+        for i in partitions])
 
 
 def partition(args, layout, size_boot, size_reserve):
@@ -63,13 +62,14 @@ def partition(args, layout, size_boot, size_reserve):
     ondev-prepare-internal-storage.sh in postmarketos-ondev.git!
 
     :param layout: partition layout from get_partition_layout()
-    :param size_boot: size of the boot partition in MiB
-    :param size_reserve: empty partition between root and boot in MiB (pma#463)
+    :param size_boot: size of the boot partition in MiB (integer)
+    :param size_reserve: empty partition between root and boot in MiB
+                         (integer, pma#463)
     """
     # Convert to MB and print info
-    mb_boot = f"{round(size_boot)}M"
-    mb_reserved = f"{round(size_reserve)}M"
-    mb_root_start = f"{round(size_boot) + round(size_reserve)}M"
+    mb_boot = f"{size_boot}M"
+    mb_reserved = f"{size_reserve}M"
+    mb_root_start = f"{size_boot + size_reserve}M"
     logging.info(f"(native) partition /dev/install (boot: {mb_boot},"
                  f" reserved: {mb_reserved}, root: the rest)")
 
@@ -89,17 +89,26 @@ def partition(args, layout, size_boot, size_reserve):
     ]
 
     if size_reserve:
-        mb_reserved_end = f"{round(size_reserve + size_boot)}M"
-        commands += [["mkpart", "primary", mb_boot, mb_reserved_end]]
+        commands += [["mkpart", "primary", mb_boot, mb_root_start]]
 
     commands += [
         ["mkpart", "primary", mb_root_start, "100%"],
         ["set", str(layout["boot"]), "boot", "on"]
     ]
 
-    for command in commands:
+    # Run all commands with one parted call first, so the device only needs
+    # to be opened and probed once. In script mode parted stops at the first
+    # command that fails though (e.g. if it fails to inform the kernel), so
+    # run them one by one with check=False as described above in that case.
+    try:
         pmb.chroot.root(args, ["parted", "-s", "/dev/install"] +
-                        command, check=False)
+                        list(itertools.chain.from_iterable(commands)))
+    except RuntimeError:
+        logging.debug("parted failed to run all commands at once, running"
+                      " them one by one")
+        for command in commands:
+            pmb.chroot.root(args, ["parted", "-s", "/dev/install"] +
+                            command, check=False)
 
 
 def partition_cgpt(args, layout, size_boot, size_reserve):
@@ -108,8 +117,9 @@ def partition_cgpt(args, layout, size_boot, size_reserve):
     one is for ChromeOS devices which use special GPT.
 
     :param layout: partition layout from get_partition_layout()
-    :param size_boot: size of the boot partition in MiB
-    :param size_reserve: empty partition between root and boot in MiB (pma#463)
+    :param size_boot: size of the boot partition in MiB (integer)
+    :param size_reserve: empty partition between root and boot in MiB
+                         (integer, pma#463)
     """
 
     pmb.chroot.apk.install(args, ["cgpt"], build=False)
@@ -120,8 +130,8 @@ def partition_cgpt(args, layout, size_boot, size_reserve):
     }
 
     # Convert to MB and print info
-    mb_boot = f"{round(size_boot)}M"
-    mb_reserved = f"{round(size_reserve)}M"
+    mb_boot = f"{size_boot}M"
+    mb_reserved = f"{size_reserve}M"
     logging.info(f"(native) partition /dev/install (boot: {mb_boot},"
                  f" reserved: {mb_reserved}, root: the rest)")
 
@@ -4,32 +4,48 @@ import os
 import logging
 import pmb
 
+# FDT magic identifier (0xd00dfeed)
+fdt_magic = b'\xd0\x0d\xfe\xed'
+# Mediatek header (0x88168858)
+mtk_magic = b'\x88\x16\x88\x58'
+# Android boot image header
+android_magic = b'ANDROID!'
+
+
+def read_header(path, size=40):
+    """ Read the beginning of a file extracted from boot.img, which is enough
+        to check for the FDT magic and to read the Mediatek header label.
+        :param path: to a file extracted from boot.img
+        :param size: amount of bytes to read
+        :returns: * None: file does not exist
+                  * bytes: the first (up to) size bytes of the file """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(size)
+    except OSError:
+        return None
+
 
-def is_dtb(path):
-    if not os.path.isfile(path):
+def is_dtb(header):
+    """ :param header: return value of read_header() """
+    if header is None:
         return False
-    with open(path, 'rb') as f:
-        # Check FDT magic identifier (0xd00dfeed)
-        return f.read(4) == b'\xd0\x0d\xfe\xed'
+    return header[:4] == fdt_magic
 
 
-def get_mtk_label(path):
+def get_mtk_label(header):
     """ Read the label of a mediatek header of kernel or ramdisk inside an
         extracted boot.img.
-        :param path: to either the kernel or ramdisk file extracted from
-                     boot.img
+        :param header: return value of read_header() for either the kernel or
+                       ramdisk file extracted from boot.img
         :returns: * None: file does not exist or does not have Mediatek header
                   * Label string (e.g. "ROOTFS", "RECOVERY", "KERNEL") """
-    if not os.path.exists(path):
+    if header is None:
         return None
 
-    with open(path, 'rb') as f:
-        # Check Mediatek header (0x88168858)
-        if not f.read(4) == b'\x88\x16\x88\x58':
-            return None
-        f.seek(8)
-        label = f.read(32).decode("utf-8").rstrip('\0')
-        return label
+    if not header[:4] == mtk_magic:
+        return None
+    return header[8:40].decode("utf-8").rstrip('\0')
 
 
 def check_mtk_bootimg(bootimg_path):
@@ -40,8 +56,8 @@ def check_mtk_bootimg(bootimg_path):
                              directory
         :returns: * True: has Mediatek headers
                   * False: has no Mediatek headers """
-    label_kernel = get_mtk_label(f"{bootimg_path}-kernel")
-    label_ramdisk = get_mtk_label(f"{bootimg_path}-ramdisk")
+    label_kernel = get_mtk_label(read_header(f"{bootimg_path}-kernel"))
+    label_ramdisk = get_mtk_label(read_header(f"{bootimg_path}-ramdisk"))
 
     # Doesn't have Mediatek headers
     if label_kernel is None and label_ramdisk is None:
@@ -82,7 +98,13 @@ def bootimg(args, path):
     logging.info("NOTE: You will be prompted for your sudo/doas password, so"
                  " we can set up a chroot to extract and analyze your"
                  " boot.img file")
-    pmb.chroot.apk.install(args, ["file", "unpackbootimg"])
+
+    # Android boot images start with this magic, 'file' is only needed to
+    # figure out what else the file is (see below)
+    with open(path, 'rb') as f:
+        is_android = f.read(8) == android_magic
+    packages = ["unpackbootimg"] if is_android else ["file", "unpackbootimg"]
+    pmb.chroot.apk.install(args, packages)
 
     temp_path = pmb.chroot.other.tempfolder(args, "/tmp/bootimg_parser")
     bootimg_path = f"{args.work}/chroot_native{temp_path}/boot.img"
@@ -92,11 +114,11 @@ def bootimg(args, path):
     pmb.helpers.run.root(args, ["cp", path, bootimg_path])
     pmb.helpers.run.root(args, ["chmod", "a+r", bootimg_path])
 
-    file_output = pmb.chroot.user(args, ["file", "-b", "boot.img"],
-                                  working_dir=temp_path,
-                                  output_return=True).rstrip()
     is_elf = False
-    if "android bootimg" not in file_output.lower():
+    if not is_android:
+        file_output = pmb.chroot.user(args, ["file", "-b", "boot.img"],
+                                      working_dir=temp_path,
+                                      output_return=True).rstrip()
         if "force" in args and args.force:
             logging.warning("WARNING: boot.img file seems to be invalid, but"
                             " proceeding anyway (-f specified)")
@@ -117,56 +139,65 @@ def bootimg(args, path):
             else:
                 raise RuntimeError("File is not an Android boot.img. (" +
                                    file_output + ")")
-    
+
     unpack_tool = "unpackelf" if is_elf else "unpackbootimg"
 
     # Extract all the files
     pmb.chroot.user(args, [unpack_tool, "-i", "boot.img"],
                     working_dir=temp_path)
 
+    # List the extracted files only once, instead of checking for each file
+    # separately if it exists
+    with os.scandir(os.path.dirname(bootimg_path)) as entries:
+        files = {entry.name: entry for entry in entries}
+
+    def extracted(name):
+        entry = files.get(f"boot.img-{name}")
+        if not entry:
+            raise RuntimeError(f"{unpack_tool} did not extract 'boot.img-"
+                               f"{name}' from '{path}'. Is this a valid"
+                               " boot.img file?")
+        return entry.path
+
+    def read(name):
+        with open(extracted(name), 'r') as f:
+            return f.read().rstrip('\n')
+
+    def read_hex(name):
+        # int() ignores the trailing newline
+        with open(extracted(name), 'rb') as f:
+            return "0x%08x" % int(f.read(), 16)
+
     output = {}
     header_version = 0
     # Get base, offsets, pagesize, cmdline and qcdt info
     # This file does not exist for example for qcdt images
-    if os.path.isfile(f"{bootimg_path}-header_version"):
-        with open(f"{bootimg_path}-header_version", 'r') as f:
-            header_version = int(f.read().replace('\n', ''))
-            output["header_version"] = str(header_version)
+    if "boot.img-header_version" in files:
+        header_version = int(read("header_version"))
+        output["header_version"] = str(header_version)
 
     if header_version >= 3:
         output["pagesize"] = "4096"
     else:
-        with open(f"{bootimg_path}-base", 'r') as f:
-            output["base"] = ("0x%08x" % int(f.read().replace('\n', ''), 16))
-        with open(f"{bootimg_path}-kernel_offset", 'r') as f:
-            output["kernel_offset"] = ("0x%08x"
-                                       % int(f.read().replace('\n', ''), 16))
-        with open(f"{bootimg_path}-ramdisk_offset", 'r') as f:
-            output["ramdisk_offset"] = ("0x%08x"
-                                        % int(f.read().replace('\n', ''), 16))
-        with open(f"{bootimg_path}-second_offset", 'r') as f:
-            output["second_offset"] = ("0x%08x"
-                                       % int(f.read().replace('\n', ''), 16))
-        with open(f"{bootimg_path}-tags_offset", 'r') as f:
-            output["tags_offset"] = ("0x%08x"
-                                     % int(f.read().replace('\n', ''), 16))
-        with open(f"{bootimg_path}-pagesize", 'r') as f:
-            output["pagesize"] = f.read().replace('\n', '')
+        output["base"] = read_hex("base")
+        output["kernel_offset"] = read_hex("kernel_offset")
+        output["ramdisk_offset"] = read_hex("ramdisk_offset")
+        output["second_offset"] = read_hex("second_offset")
+        output["tags_offset"] = read_hex("tags_offset")
+        output["pagesize"] = read("pagesize")
 
         if header_version == 2:
-            with open(f"{bootimg_path}-dtb_offset", 'r') as f:
-                output["dtb_offset"] = ("0x%08x"
-                                        % int(f.read().replace('\n', ''), 16))
+            output["dtb_offset"] = read_hex("dtb_offset")
 
-    output["qcdt"] = ("true" if os.path.isfile(f"{bootimg_path}-dt") and
-                      os.path.getsize(f"{bootimg_path}-dt") > 0 else "false")
+    dt = files.get("boot.img-dt")
+    output["qcdt"] = ("true" if dt and dt.is_file() and dt.stat().st_size > 0
+                      else "false")
     output["mtk_mkimage"] = ("true" if check_mtk_bootimg(bootimg_path)
                              else "false")
-    output["dtb_second"] = ("true" if is_dtb(f"{bootimg_path}-second")
-                            else "false")
+    header_second = read_header(f"{bootimg_path}-second")
+    output["dtb_second"] = "true" if is_dtb(header_second) else "false"
 
-    with open(f"{bootimg_path}-cmdline", 'r') as f:
-        output["cmdline"] = f.read().replace('\n', '')
+    output["cmdline"] = read("cmdline")
 
     # Cleanup
     pmb.chroot.root(args, ["rm", "-r", temp_path])
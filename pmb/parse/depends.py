@@ -1,5 +1,6 @@
 # Copyright 2023 Oliver Smith
 # SPDX-License-Identifier: GPL-3.0-or-later
+import collections
 import logging
 import pmb.chroot
 import pmb.chroot.apk
@@ -122,13 +123,20 @@ def recurse(args, pkgnames, suffix="native"):
     logging.debug(f"({suffix}) calculate depends of {', '.join(pkgnames)} "
                   "(pmbootstrap -v for details)")
 
-    # Iterate over todo-list until is is empty
-    todo = list(pkgnames)
+    # Iterate over todo-list until is is empty. Keep track of the queued
+    # entries in a counter and use a dict for ret (ordered, fast lookups), so
+    # each iteration doesn't need to go through the whole lists.
+    todo = collections.deque(pkgnames)
+    todo_count = collections.Counter(pkgnames)
     required_by = {}
-    ret = []
+    ret = {}
+    pkgnames_install = collections.ChainMap(ret, todo_count)
     while len(todo):
         # Skip already passed entries
-        pkgname_depend = todo.pop(0)
+        pkgname_depend = todo.popleft()
+        todo_count[pkgname_depend] -= 1
+        if not todo_count[pkgname_depend]:
+            del todo_count[pkgname_depend]
         if pkgname_depend in ret:
             continue
 
@@ -137,7 +145,6 @@ def recurse(args, pkgnames, suffix="native"):
         pkgname_depend = pkgname_depend.lstrip("!")
 
         # Get depends and pkgname from aports
-        pkgnames_install = list(ret) + todo
         package = package_from_aports(args, pkgname_depend)
         package = package_from_index(args, pkgname_depend, pkgnames_install,
                                      package, suffix)
@@ -170,10 +177,11 @@ def recurse(args, pkgnames, suffix="native"):
                 depends = package["depends"]
                 logging.verbose(f"{pkgname}: depends on: {','.join(depends)}")
                 if depends:
-                    todo += depends
+                    todo.extend(depends)
+                    todo_count.update(depends)
                     for dep in depends:
                         if dep not in required_by:
                             required_by[dep] = set()
                         required_by[dep].add(pkgname_depend)
-            ret.append(pkgname)
-    return ret
+            ret[pkgname] = None
+    return list(ret)
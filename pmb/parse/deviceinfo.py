@@ -134,6 +134,12 @@ def deviceinfo(args, device=None, kernel=None):
             " start a new device port or to choose another device. It may have"
             " been renamed, see <https://postmarketos.org/renamed>")
 
+    # Try to get a cached result first (we assume that the aports don't change
+    # in one pmbootstrap call)
+    cache_key = (path, kernel)
+    if cache_key in pmb.helpers.other.cache["deviceinfo"]:
+        return pmb.helpers.other.cache["deviceinfo"][cache_key]
+
     ret = {}
     with open(path) as handle:
         for line in handle:
@@ -153,4 +159,7 @@ def deviceinfo(args, device=None, kernel=None):
 
     ret = parse_kernel_suffix(args, ret, device, kernel)
     sanity_check(ret, path)
+
+    # Save result in cache
+    pmb.helpers.other.cache["deviceinfo"][cache_key] = ret
     return ret
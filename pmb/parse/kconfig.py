@@ -1,9 +1,10 @@
 # Copyright 2023 Attila Szollosi
 # SPDX-License-Identifier: GPL-3.0-or-later
-import glob
+import itertools
 import logging
 import re
 import os
+from functools import lru_cache
 
 import pmb.build
 import pmb.config
@@ -11,70 +12,106 @@ import pmb.parse
 import pmb.helpers.pmaports
 
 
+# Option names are plain ASCII, which spares matching \w against Unicode
+regex_option = re.compile(r"^CONFIG_(\w+)=(.*)$", re.A)
+regex_version = re.compile(r"# Linux/\S+ (\S+) Kernel Configuration")
+
+
+def parse_config(lines):
+    """
+    Parse all options of a kernel config at once, so checking an option
+    doesn't need to search through the whole config again.
+
+    :param lines: lines of a kernel config file, e.g. its open file handle,
+                  so the whole file doesn't need to be in memory at once
+    :returns: dict of option names (without CONFIG_) and their values, e.g.
+              {"ARM64": "y", "CMDLINE": "\"console=ttyMSM0\""}
+    """
+    ret = {}
+    for line in lines:
+        match = regex_option.match(line)
+        if match:
+            # Kernel configs have no duplicates, keep the first one anyway
+            ret.setdefault(match.group(1), match.group(2))
+    return ret
+
+
 def is_set(config, option):
     """
     Check, whether a boolean or tristate option is enabled
     either as builtin or module.
+
+    :param config: return value of parse_config()
+    """
+    return config.get(option) in ["y", "m"]
+
+
+def search_str(config, option):
     """
-    return re.search("^CONFIG_" + option + "=[ym]$", config, re.M) is not None
+    Find the string value of a config option.
+
+    :param config: return value of parse_config()
+    :returns: the value without the quotes, or None if it is not set
+    """
+    value = config.get(option)
+    if value and len(value) >= 2 and value[0] == value[-1] == "\"":
+        return value[1:-1]
+    return None
 
 
 def is_set_str(config, option, string):
     """
     Check, whether a config option contains a string as value.
     """
-    match = re.search("^CONFIG_" + option + "=\"(.*)\"$", config, re.M)
-    if match:
-        return string == match.group(1)
-    else:
-        return False
+    return string == search_str(config, option)
 
 
 def is_in_array(config, option, string):
     """
     Check, whether a config option contains string as an array element
     """
-    match = re.search("^CONFIG_" + option + "=\"(.*)\"$", config, re.M)
-    if match:
-        values = match.group(1).split(",")
-        return string in values
-    else:
+    value = search_str(config, option)
+    if value is None:
         return False
+    return string in value.split(",")
 
 
 def check_option(component, details, config, config_path_pretty, option,
                  option_value):
-    link = (f"https://wiki.postmarketos.org/wiki/kconfig#CONFIG_{option}")
-    warning_no_details = (f"WARNING: {config_path_pretty} isn't"
-                          f" configured properly for {component}, run"
-                          f" 'pmbootstrap kconfig check' for details!")
+    """
+    Check one kconfig option. With details, print a warning about what is
+    wrong with it; without details, the caller prints one summarizing warning
+    for the whole component.
+
+    :returns: True if the option is set as expected, False otherwise
+    """
     if isinstance(option_value, list):
+        # Split the array only once for all strings it should contain
+        value = search_str(config, option)
+        elements = set(value.split(",")) if value is not None else set()
         for string in option_value:
-            if not is_in_array(config, option, string):
+            if string not in elements:
                 if details:
+                    link = option_link(option)
                     logging.info(f"WARNING: {config_path_pretty}:"
                                  f' CONFIG_{option} should contain "{string}".'
                                  f" See <{link}> for details.")
-                else:
-                    logging.warning(warning_no_details)
                 return False
     elif isinstance(option_value, str):
         if not is_set_str(config, option, option_value):
             if details:
+                link = option_link(option)
                 logging.info(f"WARNING: {config_path_pretty}: CONFIG_{option}"
                              f' should be set to "{option_value}".'
                              f" See <{link}> for details.")
-            else:
-                logging.warning(warning_no_details)
             return False
     elif option_value in [True, False]:
         if option_value != is_set(config, option):
             if details:
+                link = option_link(option)
                 should = "should" if option_value else "should *not*"
                 logging.info(f"WARNING: {config_path_pretty}: CONFIG_{option}"
                              f" {should} be set. See <{link}> for details.")
-            else:
-                logging.warning(warning_no_details)
             return False
     else:
         raise RuntimeError("kconfig check code can only handle booleans,"
@@ -84,21 +121,23 @@ def check_option(component, details, config, config_path_pretty, option,
     return True
 
 
-def check_config(config_path, config_path_pretty, config_arch, pkgver,
-                 waydroid=False,
-                 iwd=False,
-                 nftables=False,
-                 containers=False,
-                 zram=False,
-                 netboot=False,
-                 community=False,
-                 uefi=False,
-                 details=False,
-                 enforce_check=True):
-    logging.debug(f"Check kconfig: {config_path}")
-    with open(config_path) as handle:
-        config = handle.read()
+def option_link(option):
+    return f"https://wiki.postmarketos.org/wiki/kconfig#CONFIG_{option}"
 
+
+@lru_cache()
+def get_components(config_arch, waydroid, iwd, nftables, containers, zram,
+                   netboot, community, uefi):
+    """
+    Assemble the kconfig option sets to check for the given architecture and
+    flags. The result is cached, as check() uses the same flags for all
+    configs of a kernel.
+
+    :returns: tuple of (component, options) pairs, with options being the
+              return value of filter_options(), e.g.
+              (("postmarketOS", ((">=0.0.0", {"ANDROID_PARANOID_NETWORK":
+                                              False, ...}), ...)), ...)
+    """
     components = {"postmarketOS": pmb.config.necessary_kconfig_options}
     if waydroid:
         components["waydroid"] = pmb.config.necessary_kconfig_options_waydroid
@@ -127,50 +166,125 @@ def check_config(config_path, config_path_pretty, config_arch, pkgver,
     if uefi:
         components["uefi"] = pmb.config.necessary_kconfig_options_uefi
 
-    results = []
-    for component, options in components.items():
-        result = check_config_options_set(config, config_path_pretty,
-                                          config_arch, options, component,
-                                          pkgver, details)
+    return tuple((component, filter_options(options, config_arch))
+                 for component, options in components.items())
+
+
+def filter_options(options, config_arch):
+    """
+    Select the option sets of a component that apply to an architecture, so
+    they don't need to be filtered again for each config that gets checked.
+
+    :param options: kconfig options of a component from pmb.config, e.g.
+                    pmb.config.necessary_kconfig_options
+    :returns: tuple of (rules, options) pairs, e.g.
+              ((">=0.0.0", {"ANDROID_PARANOID_NETWORK": False, ...}), ...)
+    """
+    ret = []
+    for rules, archs_options in options.items():
+        for archs, arch_options in archs_options.items():
+            # If option does not contain the architecture of the device
+            # kernel, then just skip the option.
+            architectures = parse_archs(archs)
+            if architectures is None or config_arch in architectures:
+                ret.append((rules, arch_options))
+    return tuple(ret)
+
+
+def check_config(config_path, config_path_pretty, config_arch, pkgver,
+                 waydroid=False,
+                 iwd=False,
+                 nftables=False,
+                 containers=False,
+                 zram=False,
+                 netboot=False,
+                 community=False,
+                 uefi=False,
+                 details=False,
+                 enforce_check=True,
+                 config=None):
+    """
+    :param config: return value of parse_config() for config_path, if the
+                   caller has read the file already
+    """
+    logging.debug("Check kconfig: %s", config_path)
+    if config is None:
+        with open(config_path) as handle:
+            config = parse_config(handle)
+
+    components = get_components(config_arch, waydroid, iwd, nftables,
+                                containers, zram, netboot, community, uefi)
+
+    ret = True
+    for component, options in components:
+        result = check_config_options_set(config, config_path_pretty, options,
+                                          component, pkgver, details)
         # We always enforce "postmarketOS" component and when explicitly
         # requested
         if enforce_check or component == "postmarketOS":
-            results += [result]
+            ret &= result
+            # Without details, the remaining components can't change the
+            # result anymore
+            if not ret and not details:
+                break
+
+    return ret
+
 
-    return all(results)
+@lru_cache()
+def check_rules(pkgver, rules):
+    """
+    Check if the kernel version matches the version rules of a set of
+    kconfig options. The result is cached, because the same rules get checked
+    for each config file of a kernel and for each component.
+
+    :param rules: space separated version rules, e.g. ">=4.0 <5.0"
+    :returns: True if pkgver matches all rules, False otherwise
+    """
+    for rule in rules.split(" "):
+        if not pmb.parse.version.check_string(pkgver, rule):
+            return False
+    return True
+
+
+@lru_cache()
+def parse_archs(archs):
+    """
+    :param archs: space separated architectures of a set of kconfig options,
+                  e.g. "armhf armv7", or "all"
+    :returns: frozenset of the architectures, or None for "all"
+    """
+    if archs == "all":
+        return None
+    return frozenset(archs.split(" "))
 
 
-def check_config_options_set(config, config_path_pretty, config_arch, options,
-                             component, pkgver, details=False):
+def check_config_options_set(config, config_path_pretty, options, component,
+                             pkgver, details=False):
+    """
+    :param options: return value of filter_options() for the config's
+                    architecture
+    """
     # Loop through necessary config options, and print a warning,
     # if any is missing
     ret = True
-    for rules, archs_options in options.items():
+    for rules, rules_options in options:
         # Skip options irrelevant for the current kernel's version
-        # Example rules: ">=4.0 <5.0"
-        skip = False
-        for rule in rules.split(" "):
-            if not pmb.parse.version.check_string(pkgver, rule):
-                skip = True
-                break
-        if skip:
+        if not check_rules(pkgver, rules):
             continue
 
-        for archs, options in archs_options.items():
-            if archs != "all":
-                # Split and check if the device's architecture architecture has
-                # special config options. If option does not contain the
-                # architecture of the device kernel, then just skip the option.
-                architectures = archs.split(" ")
-                if config_arch not in architectures:
-                    continue
-
-            for option, option_value in options.items():
-                if not check_option(component, details, config,
-                                    config_path_pretty, option, option_value):
-                    ret = False
-                    if not details:
-                        break  # do not give too much error messages
+        for option, option_value in rules_options.items():
+            if not check_option(component, details, config,
+                                config_path_pretty, option, option_value):
+                # Without details, one failed option is enough to know
+                # the result (and to not give too much error messages)
+                if not details:
+                    logging.warning(f"WARNING: {config_path_pretty} isn't"
+                                    f" configured properly for {component},"
+                                    " run 'pmbootstrap kconfig check' for"
+                                    " details!")
+                    return False
+                ret = False
     return ret
 
 
@@ -208,26 +322,30 @@ def check(args, pkgname,
     # We only enforce optional checks for community & main devices
     enforce_check = aport.split("/")[-2] in ["community", "main"]
 
+    # Look up the pmb:kconfigcheck-* options in a set
+    options = set(apkbuild["options"])
     check_waydroid = force_waydroid_check or (
-        "pmb:kconfigcheck-waydroid" in apkbuild["options"])
+        "pmb:kconfigcheck-waydroid" in options)
     check_iwd = force_iwd_check or (
-        "pmb:kconfigcheck-iwd" in apkbuild["options"])
+        "pmb:kconfigcheck-iwd" in options)
     check_nftables = force_nftables_check or (
-        "pmb:kconfigcheck-nftables" in apkbuild["options"])
+        "pmb:kconfigcheck-nftables" in options)
     check_containers = force_containers_check or (
-        "pmb:kconfigcheck-containers" in apkbuild["options"])
+        "pmb:kconfigcheck-containers" in options)
     check_zram = force_zram_check or (
-        "pmb:kconfigcheck-zram" in apkbuild["options"])
+        "pmb:kconfigcheck-zram" in options)
     check_netboot = force_netboot_check or (
-        "pmb:kconfigcheck-netboot" in apkbuild["options"])
+        "pmb:kconfigcheck-netboot" in options)
     check_community = force_community_check or (
-        "pmb:kconfigcheck-community" in apkbuild["options"])
+        "pmb:kconfigcheck-community" in options)
     check_uefi = force_uefi_check or (
-        "pmb:kconfigcheck-uefi" in apkbuild["options"])
-    for config_path in glob.glob(aport + "/config-*"):
+        "pmb:kconfigcheck-uefi" in options)
+    with os.scandir(aport) as entries:
+        configs = [(entry.path, entry.name) for entry in entries
+                   if entry.name.startswith("config-") and entry.is_file()]
+    for config_path, config_name in configs:
         # The architecture of the config is in the name, so it just needs to be
         # extracted
-        config_name = os.path.basename(config_path)
         config_name_split = config_name.split(".")
 
         if len(config_name_split) != 2:
@@ -239,7 +357,7 @@ def check(args, pkgname,
                                "elsewhere in the name.")
 
         config_arch = config_name_split[1]
-        config_path_pretty = f"linux-{flavor}/{os.path.basename(config_path)}"
+        config_path_pretty = f"linux-{flavor}/{config_name}"
         ret &= check_config(config_path, config_path_pretty, config_arch,
                             pkgver,
                             waydroid=check_waydroid,
@@ -255,32 +373,37 @@ def check(args, pkgname,
     return ret
 
 
-def extract_arch(config_file):
+# Options of a kernel config that identify its architecture
+arch_options = {"ARM": "armv7",
+                "ARM64": "aarch64",
+                "X86_32": "x86",
+                "X86_64": "x86_64"}
+
+
+def extract_arch(config):
+    """
+    :param config: return value of parse_config()
+    """
     # Extract the architecture out of the config
-    with open(config_file) as f:
-        config = f.read()
-    if is_set(config, "ARM"):
-        return "armv7"
-    elif is_set(config, "ARM64"):
-        return "aarch64"
-    elif is_set(config, "X86_32"):
-        return "x86"
-    elif is_set(config, "X86_64"):
-        return "x86_64"
+    for option, arch in arch_options.items():
+        if is_set(config, option):
+            return arch
 
     # No match
     logging.info("WARNING: failed to extract arch from kernel config")
     return "unknown"
 
 
-def extract_version(config_file):
-    # Try to extract the version string out of the comment header
-    with open(config_file) as f:
-        # Read the first 3 lines of the file and get the third line only
-        text = [next(f) for x in range(3)][2]
-    ver_match = re.match(r"# Linux/\S+ (\S+) Kernel Configuration", text)
-    if ver_match:
-        return ver_match.group(1)
+def extract_version(lines):
+    """
+    :param lines: the first lines of the kernel config file
+    """
+    # Try to extract the version string out of the comment header (third
+    # line of the file)
+    if len(lines) > 2:
+        ver_match = regex_version.match(lines[2])
+        if ver_match:
+            return ver_match.group(1)
 
     # No match
     logging.info("WARNING: failed to extract version from kernel config")
@@ -295,10 +418,16 @@ def check_file(config_file, waydroid=False, nftables=False,
 
     :returns: True when the check was successful, False otherwise
     """
-    arch = extract_arch(config_file)
-    version = extract_version(config_file)
-    logging.debug(f"Check kconfig: parsed arch={arch}, version={version} from "
-                  f"file: {config_file}")
+    # Read the file only once, for extracting arch and version as well as
+    # for the actual check
+    with open(config_file) as handle:
+        header = [handle.readline() for _ in range(3)]
+        config = parse_config(itertools.chain(header, handle))
+
+    arch = extract_arch(config)
+    version = extract_version(header)
+    logging.debug("Check kconfig: parsed arch=%s, version=%s from file: %s",
+                  arch, version, config_file)
     return check_config(config_file, config_file, arch, version,
                         waydroid=waydroid,
                         nftables=nftables,
@@ -307,4 +436,5 @@ def check_file(config_file, waydroid=False, nftables=False,
                         netboot=netboot,
                         community=community,
                         uefi=uefi,
-                        details=details)
+                        details=details,
+                        config=config)
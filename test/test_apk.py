@@ -28,7 +28,7 @@ def test_install_build(monkeypatch, args):
         return "build-pkg"
     monkeypatch.setattr(pmb.build, "package", fake_build_package)
 
-    def fake_apkindex_package(args, package, arch, must_exist):
+    def fake_apkindex_package(args, package, arch, must_exist, indexes=None):
         return ret_apkindex_package
     monkeypatch.setattr(pmb.parse.apkindex, "package", fake_apkindex_package)
 
@@ -152,3 +152,35 @@ def test_install_run_apk(monkeypatch, args):
     with pytest.raises(ValueError) as e:
         func(args, to_add, to_add_local, to_del, suffix)
     assert "Invalid package name" in str(e.value)
+
+
+def test_installed_version(args, tmpdir):
+    func = pmb.chroot.apk.installed_version
+    args.work = str(tmpdir)
+
+    tmpdir.mkdir("chroot_native").mkdir("lib").mkdir("apk").mkdir("db")
+    with open(f"{args.work}/chroot_native/lib/apk/db/installed", "w") as h:
+        h.write("C:Q1abc=\n"
+                "P:musl\n"
+                "V:1.2.4-r2\n"
+                "\n"
+                "C:Q1def=\n"
+                "P:apk-tools\n"
+                "V:2.14.0-r2\n"
+                "A:x86_64\n"
+                "\n")
+
+    assert func(args, "musl") == "1.2.4-r2"
+    assert func(args, "apk-tools") == "2.14.0-r2"
+
+    # Last line without newline
+    with open(f"{args.work}/chroot_native/lib/apk/db/installed", "w") as h:
+        h.write("C:Q1abc=\n"
+                "P:musl\n"
+                "V:1.2.4-r2")
+    assert func(args, "musl") == "1.2.4-r2"
+
+    # Package not installed
+    with pytest.raises(RuntimeError) as e:
+        func(args, "apk")
+    assert str(e.value).startswith("(native) package apk is not listed")
@@ -9,6 +9,7 @@ import pmb.chroot.apk_static
 import pmb.parse.apkindex
 import pmb.helpers.logging
 import pmb.parse.bootimg
+from pmb.parse.bootimg import get_mtk_label, is_dtb, read_header
 
 
 @pytest.fixture
@@ -146,3 +147,26 @@ def test_bootimg_v3(args):
               "mtk_mkimage": "false",
               "dtb_second": "false"}
     assert pmb.parse.bootimg(args, path) == output
+
+
+def test_bootimg_headers(tmpdir):
+    header_mtk = b"\x88\x16\x88\x58\x00\x00\x00\x00KERNEL" + b"\0" * 26
+
+    # File does not exist
+    header = read_header(f"{tmpdir}/does-not-exist")
+    assert header is None
+    assert is_dtb(header) is False
+    assert get_mtk_label(header) is None
+
+    # File is shorter than the header
+    path = f"{tmpdir}/boot.img-second"
+    with open(path, "wb") as handle:
+        handle.write(b"\xd0\x0d")
+    header = read_header(path)
+    assert header == b"\xd0\x0d"
+    assert is_dtb(header) is False
+
+    # Magic identifiers
+    assert is_dtb(b"\xd0\x0d\xfe\xed" + b"\0" * 36) is True
+    assert get_mtk_label(b"\xd0\x0d\xfe\xed" + b"\0" * 36) is None
+    assert get_mtk_label(header_mtk) == "KERNEL"
@@ -180,3 +180,70 @@ def test_generate_binary_list(args):
                        "boot_part_start": "2"}
     assert func(args, suffix, step) == [('small.bin', 424),
                                         ('binary2.bin', 324)]
+
+    # Binary that fully covers another binary
+    binaries = "binary2.bin:500,small.bin:424"
+    args.deviceinfo = {"sd_embed_firmware": binaries,
+                       "boot_part_start": "2"}
+    with pytest.raises(RuntimeError) as e:
+        func(args, suffix, step)
+    assert str(e.value).startswith("The firmware overlaps with at least one")
+
+
+def test_find_in_runlevels(args, tmpdir):
+    func = pmb.install._install.find_in_runlevels
+    args.work = str(tmpdir)
+    suffix = "rootfs_qemu-amd64"
+    runlevels = f"{args.work}/chroot_{suffix}/etc/runlevels"
+
+    # Runlevels dir does not exist
+    with pytest.raises(RuntimeError) as e:
+        func(args, suffix, "sshd")
+    assert str(e.value).startswith("Could not find OpenRC runlevels")
+
+    for runlevel in ["boot", "default"]:
+        os.makedirs(f"{runlevels}/{runlevel}")
+
+    # Service not enabled
+    open(f"{runlevels}/boot/networking", "w").close()
+    assert func(args, suffix, "sshd") == []
+
+    # Service enabled (as symlink, like rc-update does it)
+    os.symlink("/etc/init.d/sshd", f"{runlevels}/default/sshd")
+    assert func(args, suffix, "sshd") == ["default/sshd"]
+
+
+def test_partition(args, monkeypatch):
+    func = pmb.install.partition
+    args.deviceinfo = {"boot_filesystem": "",
+                       "boot_part_start": "",
+                       "partition_type": ""}
+    layout = {"boot": 1}
+    cmds = []
+    parted_ok = True
+
+    def fake_root(args, cmd, check=None):
+        cmds.append(cmd)
+        if len(cmds) == 1 and not parted_ok:
+            raise RuntimeError("Command failed")
+    monkeypatch.setattr(pmb.chroot, "root", fake_root)
+
+    # All commands at once
+    func(args, layout, 256, 0)
+    assert cmds == [["parted", "-s", "/dev/install",
+                     "mktable", "msdos",
+                     "mkpart", "primary", "ext2", "2048s", "256M",
+                     "mkpart", "primary", "256M", "100%",
+                     "set", "1", "boot", "on"]]
+
+    # Fall back to one parted call per command
+    cmds = []
+    parted_ok = False
+    func(args, layout, 256, 0)
+    assert cmds[1:] == [["parted", "-s", "/dev/install", "mktable", "msdos"],
+                        ["parted", "-s", "/dev/install", "mkpart", "primary",
+                         "ext2", "2048s", "256M"],
+                        ["parted", "-s", "/dev/install", "mkpart", "primary",
+                         "256M", "100%"],
+                        ["parted", "-s", "/dev/install", "set", "1", "boot",
+                         "on"]]
@@ -65,3 +65,77 @@ def test_kconfig_check(args):
 
     # supports zram (with pmb:kconfigcheck-zram), nftables
     assert pmb.parse.kconfig.check(args, "linux-purism-librem5")
+
+
+def test_kconfig_parse_config():
+    config = pmb.parse.kconfig.parse_config(
+        "#\n"
+        "# Automatically generated file; DO NOT EDIT.\n"
+        "#\n"
+        "CONFIG_ARM64=y\n"
+        "CONFIG_MODULES=m\n"
+        "# CONFIG_SWAP is not set\n"
+        "CONFIG_LSM=\"landlock,lockdown,yama\"\n"
+        "CONFIG_CMDLINE=\"\"\n"
+        "CONFIG_NR_CPUS=8\n".splitlines(True))
+    assert config == {"ARM64": "y",
+                      "MODULES": "m",
+                      "LSM": "\"landlock,lockdown,yama\"",
+                      "CMDLINE": "\"\"",
+                      "NR_CPUS": "8"}
+
+    assert pmb.parse.kconfig.is_set(config, "ARM64")
+    assert pmb.parse.kconfig.is_set(config, "MODULES")
+    assert not pmb.parse.kconfig.is_set(config, "SWAP")
+    assert not pmb.parse.kconfig.is_set(config, "NR_CPUS")
+
+    assert pmb.parse.kconfig.is_set_str(config, "CMDLINE", "")
+    assert not pmb.parse.kconfig.is_set_str(config, "NR_CPUS", "8")
+    assert pmb.parse.kconfig.is_in_array(config, "LSM", "yama")
+    assert not pmb.parse.kconfig.is_in_array(config, "LSM", "selinux")
+    assert not pmb.parse.kconfig.is_in_array(config, "SWAP", "yama")
+
+
+def test_kconfig_check_rules():
+    func = pmb.parse.kconfig.check_rules
+    assert func("4.4.302", ">=0.0.0")
+    assert func("4.4.302", ">=4.0 <5.0")
+    assert not func("5.15.0", ">=4.0 <5.0")
+    assert not func("3.10.108", ">=4.0 <5.0")
+
+
+def test_kconfig_parse_archs():
+    func = pmb.parse.kconfig.parse_archs
+    assert func("all") is None
+    assert func("aarch64") == {"aarch64"}
+    assert func("armhf armv7") == {"armhf", "armv7"}
+
+
+def test_kconfig_filter_options():
+    func = pmb.parse.kconfig.filter_options
+    options = {">=0.0.0": {"all": {"A": True},
+                           "armhf armv7": {"B": True}},
+               ">=5.0": {"aarch64": {"C": False}}}
+    assert func(options, "armv7") == ((">=0.0.0", {"A": True}),
+                                      (">=0.0.0", {"B": True}))
+    assert func(options, "aarch64") == ((">=0.0.0", {"A": True}),
+                                        (">=5.0", {"C": False}))
+
+
+def test_kconfig_get_components():
+    func = pmb.parse.kconfig.get_components
+
+    def names(*flags):
+        return [component for component, _ in func("aarch64", *flags)]
+
+    # waydroid, iwd, nftables, containers, zram, netboot, community, uefi
+    assert names(False, False, False, False, False, False, False, False) == \
+        ["postmarketOS"]
+    assert names(True, False, False, False, True, False, False, True) == \
+        ["postmarketOS", "waydroid", "zram", "uefi"]
+
+    # Components enabled on their own come first, then the ones that
+    # community adds
+    assert names(False, False, False, False, True, False, True, False) == \
+        ["postmarketOS", "zram", "waydroid", "iwd", "nftables", "containers",
+         "netboot", "wireguard", "filesystems", "community"]
@@ -23,3 +23,23 @@ def test_umount_all_list(tmpdir):
     ret = pmb.helpers.mount.umount_all_list("/test", fake_mounts)
     assert ret == ["/test/var/cache", "/test/proc", "/test/home/pmos/packages",
                    "/test/dev/loop0p2", "/test"]
+
+
+def test_bind_files(monkeypatch):
+    cmds = []
+
+    def fake_root(args, cmd):
+        cmds.append(cmd)
+    monkeypatch.setattr(pmb.helpers.run, "root", fake_root)
+    func = pmb.helpers.mount.bind_files
+
+    # Existing mountpoints get skipped, the rest is mounted in one call
+    func(None, [("/dev/null", "/proc"), ("/dev/loop0p1", "/test/installp1"),
+                ("/dev/loop0p2", "/test/installp2")])
+    assert cmds == [["sh", "-c", pmb.helpers.mount.bind_files_script, "-",
+                     "/dev/loop0p1", "/test/installp1",
+                     "/dev/loop0p2", "/test/installp2"]]
+
+    # Nothing to mount
+    func(None, [("/dev/null", "/proc")])
+    assert len(cmds) == 1